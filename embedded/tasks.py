@@ -3,10 +3,22 @@ from invoke import task  # type: ignore
 
 
 def get_mount_point():
-    mount_point = None
-    for root, dirs, _ in os.walk("/media"):
-        if "CIRCUITPY" in dirs:
-            mount_point = os.path.join(root, "CIRCUITPY")
+    # the drive is mounted as /media/CIRCUITPY or /media/<user>/CIRCUITPY,
+    # check these two levels instead of walking all mounted file systems
+    try:
+        with os.scandir("/media") as entries:
+            subdirs = []
+            for entry in entries:
+                if entry.is_dir():
+                    if entry.name == "CIRCUITPY":
+                        return entry.path
+                    subdirs.append(entry.path)
+    except OSError:
+        subdirs = []
+
+    for subdir in subdirs:
+        mount_point = os.path.join(subdir, "CIRCUITPY")
+        if os.path.isdir(mount_point):
             return mount_point
 
     raise FileNotFoundError("CIRCUITPY mount point not found")
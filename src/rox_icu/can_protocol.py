@@ -41,9 +41,31 @@ except ImportError:  # pragma: no cover
 if TYPE_CHECKING:
     from typing import Type, NamedTuple, Tuple  # pragma: no cover
 
+try:  # precompiled formats, micropython struct has no Struct class
+    Struct = struct.Struct
+except AttributeError:  # pragma: no cover
+
+    class Struct:  # type: ignore
+        """Minimal struct.Struct replacement"""
+
+        def __init__(self, format: str) -> None:  # pylint: disable=redefined-builtin
+            self.format = format
+            self.size = struct.calcsize(format)
+
+        def pack(self, *values):
+            return struct.pack(self.format, *values)
+
+        def unpack(self, data):
+            return struct.unpack(self.format, data)
+
 
 VERSION = 12
 
+# message id layout: node id in the upper 6 bits, opcode in the lower 5 bits
+OPCODE_BITS = 5
+OPCODE_MASK = (1 << OPCODE_BITS) - 1  # 0x1F
+NODE_ID_MASK = 0x3F << OPCODE_BITS  # 0x7E0
+
 
 # -----------------Data Types-----------------
 # See https://docs.python.org/3/library/struct.html#format-characters
@@ -112,25 +134,32 @@ _MSG_DEFS = {
         ]
     )
 }
-_OPCODE2MSG = {v[0]: k for k, v in _MSG_DEFS.items()}
+# message: compiled byte_def, for fixed length messages
+_STRUCTS = {
+    msg: Struct(byte_def) for msg, (_, byte_def) in _MSG_DEFS.items() if byte_def
+}
+# opcode: (message, compiled byte_def), single lookup when decoding
+_OPCODE2DEF = {
+    opcode: (msg, _STRUCTS.get(msg)) for msg, (opcode, _) in _MSG_DEFS.items()
+}
 
 
 # ----------------------------Utility Functions----------------------------
 def generate_message_id(node_id: int, opcode: int) -> int:
     """Generates an 11-bit message ID from opcode and node ID."""
-    return (node_id << 5) | opcode
+    return (node_id << OPCODE_BITS) | opcode
 
 
 def split_message_id(message_id: int) -> "tuple[int, int]":
     """Splits a 11-bit message ID into opcode and node ID."""
-    opcode = message_id & 0x1F  # Extract lower 5 bits for cmd_id
-    node_id = message_id >> 5  # Shift right by 5 bits to get node_id
+    opcode = message_id & OPCODE_MASK  # Extract lower 5 bits for cmd_id
+    node_id = message_id >> OPCODE_BITS  # Shift right by 5 bits to get node_id
     return node_id, opcode
 
 
 def get_node_id(message_id: int) -> int:
     """Get the node ID from a message ID."""
-    return message_id >> 5
+    return message_id >> OPCODE_BITS
 
 
 def get_opcode_and_bytedef(message_class: "Type[NamedTuple]") -> "Tuple[int, str]":
@@ -143,20 +172,20 @@ def encode_message(message: "NamedTuple", node_id: int) -> "Tuple[int, bytes]":
     """Pack a message into arbitration ID and data bytes.
     returns: (arbitration_id, data_bytes)"""
 
-    opcode, byte_def = get_opcode_and_bytedef(type(message))
+    opcode, _ = get_opcode_and_bytedef(type(message))
     arbitration_id = generate_message_id(node_id, opcode)
 
     if isinstance(message, ParameterMessage):  # custom byte_def for variable length
         byte_def = "<BBB" + chr(message.dtype)
+        return arbitration_id, struct.pack(byte_def, *message)
 
-    return arbitration_id, struct.pack(byte_def, *message)
+    return arbitration_id, _STRUCTS[type(message)].pack(*message)
 
 
 # Note: not using can.Message because it's not available in MicroPython
 def decode_message(arb_id: int, data: "bytes | bytearray") -> "NamedTuple":
     """Parse a message from raw data."""
-    opcode = arb_id & 0x1F
-    message_class = _OPCODE2MSG[opcode]
+    message_class, compiled = _OPCODE2DEF[arb_id & OPCODE_MASK]
 
     if message_class == ParameterMessage:
         param_id, op, dtype = data[:3]
@@ -164,4 +193,4 @@ def decode_message(arb_id: int, data: "bytes | bytearray") -> "NamedTuple":
 
         return ParameterMessage(param_id, op, dtype, value)
 
-    return message_class(*struct.unpack(_MSG_DEFS[message_class][1], data))  # type: ignore
+    return message_class(*compiled.unpack(data))  # type: ignore
@@ -147,7 +147,7 @@ class ICU:
     def io_state(self, state: int) -> None:
         """Set output state, provide a byte for all 8 outputs"""
 
-        self._log.debug(f"> {self._node_id=} {state=}")
+        self._log.debug("> node_id=%d state=%02x", self._node_id, state)
 
         self.check_alive()
 
@@ -172,8 +172,9 @@ class ICU:
         self._heartbeat_event.clear()
         self._log.debug("waiting for heartbeat")
         try:
-            await asyncio.wait_for(self._heartbeat_event.wait(), timeout)
-        except asyncio.TimeoutError as e:
+            async with asyncio.timeout(timeout):
+                await self._heartbeat_event.wait()
+        except TimeoutError as e:
             raise HeartbeatError("Timeout waiting for heartbeat") from e
 
     @property
@@ -253,7 +254,7 @@ class ICU:
                     self._log.warning("RTR message received")
                     continue
 
-                self._log.debug(f"< {node_id=} {opcode=}")
+                self._log.debug("< node_id=%d opcode=%d", node_id, opcode)
 
                 if self._running:  # Check again before queueing
                     asyncio.run_coroutine_threadsafe(
@@ -268,12 +269,15 @@ class ICU:
         self._log.debug("CAN reader thread stopped")
 
     def _uptate_io_state(self, io_state: int) -> None:
-        """Update IO state"""
+        """Update IO state, only pins that changed are visited"""
+        changed = self._io_state ^ io_state
         self._io_state = io_state
 
-        for i in range(8):
+        while changed:
+            lsb = changed & -changed  # lowest changed bit
             # pylint: disable=protected-access
-            self.pins[i]._update(bool(io_state & (1 << i)))
+            self.pins[lsb.bit_length() - 1]._update(bool(io_state & lsb))
+            changed ^= lsb
 
     async def _message_handler(self) -> None:
         """Handle received messages"""
@@ -289,9 +293,12 @@ class ICU:
                     self._last_heartbeat_time = time.time()
                     self._uptate_io_state(self._last_heartbeat.io_state)
                     self._heartbeat_event.set()
-                    self._log.debug(f"heartbeat: {self._last_heartbeat}")
+                    self._log.debug("heartbeat: %s", msg)
 
-                elif isinstance(msg, canp.IoStateMessage):
+                elif (
+                    isinstance(msg, canp.IoStateMessage)
+                    and msg.op != canp.Operation.SET
+                ):  # set commands are not state reports, ignore own echoes
                     self._uptate_io_state(msg.io_state)
 
             except asyncio.CancelledError:
@@ -39,31 +39,168 @@ Copyright (c) 2024 ROX Automation - Jev Kuznetsov
 """
 
 import asyncio
-import orjson
+import contextlib
 import logging
+import queue
+import struct
+import threading
+import time
+from typing import Literal
 
 import aiomqtt
 import can
+import msgspec
 from can.interfaces.socketcan import SocketcanBus
 from can.interfaces.udp_multicast import UdpMulticastBus
 
+try:  # optional, faster event loop
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None  # type: ignore
+
 import rox_icu.can_protocol as canp
 from rox_icu.can_utils import get_can_bus
+from rox_icu.core import AutoClearEvent
 from rox_icu.utils import run_main
-from rox_icu.bit_ops import set_bit, clear_bit
 
 # Constants for CAN messages
 NODE_ID = 0x01
 DEVICE_TYPE = 201
 
+TX_QUEUE_SIZE = 256  # max number of frames waiting to be sent
+RX_TIMEOUT = 0.1  # notifier recv timeout, bounds how long stopping it takes
+TOGGLE_TICKS = 5  # simulated inputs toggle every 5 heartbeats (500ms)
+
+IO_STATE_OPCODE, _ = canp.get_opcode_and_bytedef(canp.IoStateMessage)
+
+
+def field_offset(message_class: type, field: str) -> int:
+    """Byte offset of a field in a fixed-length message."""
+    _, byte_def = canp.get_opcode_and_bytedef(message_class)  # type: ignore
+    index = message_class._fields.index(field)  # type: ignore
+    return struct.calcsize(byte_def[: index + 1])  # byte_def[0] is byte order
+
+
+# heartbeat fields that change every tick
+HB_IO_STATE_OFFSET = field_offset(canp.HeartbeatMessage, "io_state")
+HB_COUNTER_OFFSET = field_offset(canp.HeartbeatMessage, "counter")
+
 # CAN logger to INFO level
 logger_can = logging.getLogger("can")
 if logger_can is not None:
     logger_can.setLevel(logging.INFO)
 
 
+async def sleep_until_next(deadline_ns: int, period_ns: int) -> int:
+    """Sleep until the next periodic deadline, return that deadline.
+
+    Deadlines are integer `time.monotonic_ns()` values advanced by a fixed
+    period, so neither work between ticks nor float rounding accumulates as
+    drift. If the loop is more than one period late, the schedule is reset to
+    now instead of bursting to catch up.
+    """
+    deadline_ns += period_ns
+    now_ns = time.monotonic_ns()
+    if now_ns - deadline_ns > period_ns:
+        deadline_ns = now_ns
+    await asyncio.sleep(max(0, deadline_ns - now_ns) / 1e9)
+    return deadline_ns
+
+
+class SetPinArgs(msgspec.Struct):
+    pin: int
+    state: bool | int
+
+
+class SetPinCommand(msgspec.Struct):
+    """MQTT command, {"cmd": "set_pin", "args": {"pin": 0, "state": 1}}"""
+
+    cmd: Literal["set_pin"]  # a single struct makes a tag optional, require it
+    args: SetPinArgs
+
+
+class SharedNotifier:
+    """A single `can.Notifier` per bus, shared by all mocks on that bus.
+
+    Received frames are dispatched by node id to one asyncio queue per
+    subscriber, and the bus filter covers all subscribed node ids.
+    """
+
+    def __init__(self, bus: can.BusABC) -> None:
+        self._bus = bus
+        self._bus_filters = bus.filters  # restored after the last unsubscribe
+        # node_id: (loop, queue)
+        self._subscribers: dict[
+            int, tuple[asyncio.AbstractEventLoop, asyncio.Queue[can.Message]]
+        ] = {}
+        self._notifier = can.Notifier(
+            bus, [self._on_message_received], timeout=RX_TIMEOUT
+        )
+
+    @classmethod
+    def get_or_create(cls, bus: can.BusABC) -> "SharedNotifier":
+        """Get the notifier for a bus, create it if needed."""
+        if bus not in _shared_notifiers:
+            _shared_notifiers[bus] = cls(bus)
+        return _shared_notifiers[bus]
+
+    def subscribe(self, node_id: int) -> asyncio.Queue[can.Message]:
+        """Subscribe to frames for a node id, returns a queue owned by the
+        running event loop."""
+        if node_id in self._subscribers:
+            raise ValueError(f"Node {node_id} is already subscribed")
+
+        rx_queue: asyncio.Queue[can.Message] = asyncio.Queue()
+        self._subscribers[node_id] = (asyncio.get_running_loop(), rx_queue)
+        self._update_filters()
+        return rx_queue
+
+    async def unsubscribe(self, node_id: int) -> None:
+        """Unsubscribe a node id, stops the notifier after the last one."""
+        self._subscribers.pop(node_id, None)
+
+        if self._subscribers:
+            self._update_filters()
+            return
+
+        # a shared bus gets its original filters back, new subscribers get a
+        # fresh notifier while this one is stopping
+        self._bus.set_filters(self._bus_filters)
+        _shared_notifiers.pop(self._bus, None)
+        # stop joins the reader thread, which may be blocked in bus.recv
+        await asyncio.to_thread(self._notifier.stop)
+
+    def _update_filters(self) -> None:
+        """Only receive frames for subscribed nodes, filtered by the kernel on socketcan."""
+        self._bus.set_filters(
+            [
+                {
+                    "can_id": canp.generate_message_id(node_id, 0),
+                    "can_mask": canp.NODE_ID_MASK,
+                    "extended": False,
+                }
+                for node_id in self._subscribers
+            ]
+        )
+
+    def _on_message_received(self, msg: can.Message) -> None:
+        """Called from the notifier thread."""
+        subscriber = self._subscribers.get(msg.arbitration_id >> canp.OPCODE_BITS)
+        if subscriber is not None:
+            loop, rx_queue = subscriber
+            loop.call_soon_threadsafe(rx_queue.put_nowait, msg)
+
+
+_shared_notifiers: dict[can.BusABC, SharedNotifier] = {}
+
+
 class ICUMock:
-    """Class to mock the ICU CAN interface."""
+    """Class to mock the ICU CAN interface.
+
+    A `can_bus` passed in is shared, it is not shut down on close. While the
+    mock runs, the bus only receives frames for the subscribed node ids; its
+    filters are restored when the last mock on it stops.
+    """
 
     MQTT_BASE_TOPIC = "/icu_mock"
 
@@ -77,55 +214,112 @@ class ICUMock:
         self._log = logging.getLogger(f"icu.mock.{node_id}")
         self.node_id = node_id
 
-        self._io_state = 0  # Represents the state of all I/Os (8 bits for 8 I/Os)
+        # io state report (op, io_state), byte 1 holds the state of all
+        # I/Os (8 bits for 8 I/Os) and is the only copy of it
+        self._io_buf = bytearray(2)
         self.error_max1 = 0
         self.error_max2 = 0
 
         self._simulate_inputs = simulate_inputs
 
+        self._owns_bus = can_bus is None  # a shared bus is left running on close
         self._bus = can_bus or get_can_bus()
-        self._can_reader = can.AsyncBufferedReader()
-        self._notifier = can.Notifier(self._bus, [self._can_reader])
+
+        # bus.send is blocking, keep it out of the event loop
+        self._tx_queue: queue.Queue[can.Message | None] = queue.Queue(
+            maxsize=TX_QUEUE_SIZE
+        )
+        # frames alias their buffers, a queued frame goes out with the newest
+        # data and is not queued again. Cleared by the TX thread before sending
+        self._tx_pending: set[can.Message] = set()
+        self._tx_thread = threading.Thread(target=self._tx_worker, daemon=True)
+        self._tx_thread.start()
+
+        # data aliases the io state buffer
+        self._io_msg = can.Message(
+            arbitration_id=canp.generate_message_id(node_id, IO_STATE_OPCODE),
+            data=self._io_buf,
+            is_extended_id=False,
+        )
+
+        # heartbeat is sent every tick, encode it once and reuse the frame.
+        # static fields: device_type, io_dir (all outputs), errors
+        hb_id, hb_data = canp.encode_message(
+            canp.HeartbeatMessage(DEVICE_TYPE, 0, 0, 0, 0), node_id
+        )
+        self._hb_buf = bytearray(hb_data)
+        self._hb_msg = can.Message(
+            arbitration_id=hb_id, data=self._hb_buf, is_extended_id=False
+        )
 
         self._mqtt_broker = mqtt_broker
+        self._cmd_decoder = msgspec.json.Decoder(SetPinCommand)
 
-        self._state_queue: asyncio.Queue[int] = (
-            asyncio.Queue()
-        )  # queue for state updates
+        # set on every state change, cleared once all waiters have woken up.
+        # the MQTT publisher waits on it and reads the latest state
+        self.io_state_changed = AutoClearEvent()
 
     @property
-    def io_state(self):
+    def io_state(self) -> int:
         """Get the IO state."""
-        return self._io_state
+        return self._io_buf[1]
 
     @io_state.setter
     def io_state(self, new_state: int) -> None:
-        """Set the IO state."""
-        self._log.info(f"Setting IO state: {new_state:02x}")
-        self._io_state = new_state
-
-        arb_id, data_bytes = canp.encode_message(
-            canp.IoStateMessage(0, self._io_state), self.node_id
-        )
+        """Set the IO state, nothing is sent if the state is unchanged."""
+        new_state &= 0xFF
+        if new_state == self._io_buf[1]:
+            return
 
-        message = can.Message(
-            arbitration_id=arb_id,
-            data=data_bytes,
-            is_extended_id=False,
-        )
-        self._bus.send(message)
+        self._log.debug("Setting IO state: %02x", new_state)
+        self._io_buf[1] = new_state
+        self._send(self._io_msg)
+        self.io_state_changed.set()
+
+    def _send(self, message: can.Message | None) -> None:
+        """Queue a message for sending, drop the oldest one if the queue is full.
+        A frame that is still queued is skipped, it will be sent with the newest
+        data of its buffer. None stops the TX thread."""
+        if message is not None:
+            if message in self._tx_pending:
+                return
+            self._tx_pending.add(message)
+
+        try:
+            self._tx_queue.put_nowait(message)
+        except queue.Full:
+            try:
+                self._tx_pending.discard(self._tx_queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._tx_queue.put_nowait(message)
 
-        # Update the state queue
-        if self._mqtt_broker is not None:
-            self._state_queue.put_nowait(new_state)
+    def _tx_worker(self) -> None:
+        """Send queued messages, runs in a separate thread."""
+        while True:
+            message = self._tx_queue.get()
+            if message is None:
+                break
+            # an update while sending queues the frame again instead of being lost
+            self._tx_pending.discard(message)
+            try:
+                self._bus.send(message)
+            except can.CanError as e:
+                self._log.error("Error sending message: %s", e)
 
     def set_pin(self, pin: int, state: bool) -> None:
         """Set the state of a pin."""
-        self._log.info(f"Setting pin {pin} to {state}")
-        if state:
-            self.io_state = set_bit(self._io_state, pin)
-        else:
-            self.io_state = clear_bit(self._io_state, pin)
+        self._log.debug("Setting pin %d to %s", pin, state)
+        mask = 1 << pin
+        self.io_state = (self.io_state & ~mask) | (-bool(state) & mask)
+
+    def enable_toggles(self) -> None:
+        """Start toggling output 7 from the tick loop (simulated inputs)."""
+        self._simulate_inputs = True
+
+    def disable_toggles(self) -> None:
+        """Stop toggling output 7, the last state is kept."""
+        self._simulate_inputs = False
 
     def get_global_error(self) -> tuple[int, int]:
         """Return the error status of max1 and max2."""
@@ -135,70 +329,71 @@ class ICUMock:
         """Handle received CAN messages."""
         self._log.info("Starting message handler")
 
-        while True:
-            try:
-                raw_msg = await self._can_reader.get_message()
+        notifier = SharedNotifier.get_or_create(self._bus)
+        rx_queue = notifier.subscribe(self.node_id)
 
-                node_id = canp.get_node_id(raw_msg.arbitration_id)
+        try:
+            while True:
+                self._process_message(await rx_queue.get())
 
-                # Ignore messages that are not for this node ID
-                if node_id != self.node_id:
-                    continue
+                # drain frames that arrived meanwhile without awaiting each one
+                while not rx_queue.empty():
+                    self._process_message(rx_queue.get_nowait())
 
-                self._log.debug(
-                    f"Received message ID: {raw_msg.arbitration_id:x}, Data: {raw_msg.data.hex(' ')}"
-                )
+        finally:
+            await notifier.unsubscribe(self.node_id)
 
-                msg = canp.decode_message(raw_msg.arbitration_id, raw_msg.data)
-
-                if isinstance(msg, canp.IoStateMessage):
-                    self._log.info(f"Received IOSetMessage: {msg.io_state:02x}")
-                    self.io_state = msg.io_state
+    def _process_message(self, raw_msg: can.Message) -> None:
+        """Handle a single received CAN message."""
+        if self._log.isEnabledFor(logging.DEBUG):
+            self._log.debug(
+                "Received message ID: %x, Data: %s",
+                raw_msg.arbitration_id,
+                raw_msg.data.hex(" "),
+            )
 
-            except Exception as e:
-                self._log.error(f"Error in message handler: {e}")
+        # only IoStateMessage is handled, check opcode before decoding
+        if raw_msg.arbitration_id & canp.OPCODE_MASK != IO_STATE_OPCODE:
+            return
 
-    async def heartbeat_loop(self, delay: float = 0.1) -> None:
-        """Send heartbeat message."""
-        self._log.info("Starting heartbeat loop")
+        try:
+            op, io_state = raw_msg.data  # (op, io_state), one byte each
+        except ValueError as e:  # wrong number of bytes
+            self._log.warning("Malformed frame %x: %s", raw_msg.arbitration_id, e)
+            return
 
-        counter = 0
+        # state reports (including our own echoes) are not commands
+        if op == canp.Operation.SET:
+            self._log.debug("Received IOSetMessage: %02x", io_state)
+            self.io_state = io_state
 
-        while True:
-            # Construct the heartbeat message
-            heartbeat = canp.HeartbeatMessage(
-                device_type=DEVICE_TYPE,
-                io_dir=0,  # All outputs
-                io_state=self._io_state,
-                errors=0,
-                counter=counter,  # Increment counter for each loop
-            )
+    def _send_heartbeat(self, counter: int) -> None:
+        """Send heartbeat message."""
+        # static fields are packed once in __init__
+        self._hb_buf[HB_IO_STATE_OFFSET] = self._io_buf[1]
+        self._hb_buf[HB_COUNTER_OFFSET] = counter
 
-            arb_id, data_bytes = canp.encode_message(heartbeat, self.node_id)
+        # the frame aliases the buffer, if still queued for TX it is sent
+        # with the newest values
+        self._send(self._hb_msg)
 
-            message = can.Message(
-                arbitration_id=arb_id,
-                data=data_bytes,
-                is_extended_id=False,
-            )
-            self._bus.send(message)
-            counter += 1
-            counter &= 0xFF  # Wrap around at 255
-            await asyncio.sleep(delay)
-
-    async def toggle_outputs(self):
-        """Toggle the output pins."""
-        if not self._simulate_inputs:
-            return
+    async def tick_loop(self, period: float = 0.1) -> None:
+        """Send heartbeat every tick, toggle outputs every TOGGLE_TICKS ticks
+        when simulating inputs."""
+        self._log.info("Starting tick loop")
 
-        self._log.info("Starting output toggling loop")
+        ticks = 0
+        period_ns = round(period * 1e9)
+        next_ns = time.monotonic_ns()
 
         while True:
+            if self._simulate_inputs and ticks % TOGGLE_TICKS == 0:
+                # toggle bit 7
+                self.io_state ^= 0x80
 
-            # toggle bit 7
-            self.io_state ^= 0x80
-
-            await asyncio.sleep(0.5)
+            self._send_heartbeat(ticks & 0xFF)  # counter wraps around at 255
+            ticks += 1
+            next_ns = await sleep_until_next(next_ns, period_ns)
 
     async def send_mqtt_state(self, client: aiomqtt.Client):
         """Send the current I/O state to the MQTT broker."""
@@ -207,16 +402,14 @@ class ICUMock:
         self._log.info(f"Publishing state to MQTT topic: {state_topic}")
 
         while True:
-            state = await self._state_queue.get()
-            await client.publish(state_topic, state)
-            self._state_queue.task_done()
+            # changes made while publishing are coalesced into one update
+            await self.io_state_changed.wait()
+            await client.publish(state_topic, self.io_state)
 
     async def receive_mqtt_commands(self, client: aiomqtt.Client):
         """Receive and process MQTT commands."""
         self._log.info("Receiving MQTT commands")
 
-        commands = {"set_pin": self.set_pin}
-
         cmd_topic = f"{self.MQTT_BASE_TOPIC}/{self.node_id}/cmd"
 
         self._log.info(f"Subscribing to MQTT topic: {cmd_topic}")
@@ -224,22 +417,15 @@ class ICUMock:
         await client.subscribe(cmd_topic)
         async for message in client.messages:
             try:
-                self._log.info(f"{message.topic=}, {message.payload=}")
+                self._log.debug("topic=%s, payload=%r", message.topic, message.payload)
                 if not isinstance(message.payload, (str, bytes, bytearray)):
                     raise TypeError(f"Unexpected payload type {type(message.payload)}")
 
-                payload = orjson.loads(message.payload)
-
-                # command format {"cmd": "set_pin", "args: {"pin": 0, "state": 1}}
-                cmd = payload["cmd"]
-                args = payload["args"]
+                # unknown commands fail validation in the decoder
+                command = self._cmd_decoder.decode(message.payload)
+                self.set_pin(command.args.pin, bool(command.args.state))
 
-                if cmd not in commands:
-                    raise ValueError(f"Invalid command: {cmd}")
-
-                commands[cmd](**args)
-
-            except (TypeError, orjson.JSONDecodeError) as e:
+            except (TypeError, msgspec.DecodeError) as e:
                 self._log.error(f"Error decoding message {message.payload!r}: {e}")
 
             except Exception as e:
@@ -258,21 +444,26 @@ class ICUMock:
                 tg.create_task(self.receive_mqtt_commands(client))
 
     async def main(self):
-        """Main async loop for the ICU mock."""
-        async with asyncio.TaskGroup() as tg:
-            tg.create_task(self.heartbeat_loop())
+        """Main async loop for the ICU mock, closes the mock on exit."""
+        async with contextlib.aclosing(self), asyncio.TaskGroup() as tg:
+            tg.create_task(self.tick_loop())
             tg.create_task(self.message_handler())
-            tg.create_task(self.toggle_outputs())
             tg.create_task(self.mqtt_loop())
 
     def start(self):
-        """Start the main loop."""
-        asyncio.run(self.main())
-
-    def __del__(self):
-        """Destructor to clean up resources."""
-        self._notifier.stop()
-        self._bus.shutdown()
+        """Start the main loop, using uvloop if it is installed."""
+        if uvloop is not None:
+            uvloop.run(self.main())
+        else:
+            asyncio.run(self.main())
+
+    async def aclose(self) -> None:
+        """Stop the TX thread and shut down the bus if it is owned by the mock."""
+        self._log.info("Shutting down")
+        self._send(None)  # stop sentinel, never blocks on a full queue
+        await asyncio.to_thread(self._tx_thread.join, 1.0)
+        if self._owns_bus:
+            self._bus.shutdown()
 
 
 def main(node_id: int = NODE_ID):
@@ -8,10 +8,16 @@ Copyright (c) 2024 ROX Automation - Jev Kuznetsov
 
 from __future__ import annotations
 
+import asyncio
+import bisect
 import curses
+import os
 import signal
 import struct
-from dataclasses import dataclass
+from collections import deque
+from dataclasses import dataclass, field
+from types import FrameType
+from typing import Callable
 
 import can
 
@@ -20,80 +26,175 @@ from rox_icu.can_utils import get_can_bus
 
 
 HB_OPCODE, HB_BYTEDEF = canp.get_opcode_and_bytedef(canp.HeartbeatMessage)
+_HB_STRUCT = struct.Struct(HB_BYTEDEF)  # compiled once, used for every heartbeat
 
+HEADER = f"| {'NodeID':<6} | {'DevType':<7} | {'IO Dir':<8} | {'IO State':<8} | {'Error':<4} | {'Counter':<7} |"
+SEPARATOR = "-" * len(HEADER)
+
+_IO_BIN = [f"{i:08b}" for i in range(256)]  # io byte -> binary column text
+
+RENDER_PERIOD = 0.05  # display refresh interval, seconds
+RX_BUFFER_SIZE = 4096  # frames buffered between redraws, oldest are dropped
+PAD_ROWS = 1000  # maximum number of table rows
+
+# device state is only touched from the event loop thread, the notifier
+# thread just appends frames to the rx buffer, so no locking is needed
 devices: dict[int, Device] = {}
+_sorted_ids: list[int] = []  # device ids in display order, kept on insert
 should_exit = False
+screen_resized = False  # set on SIGWINCH, screen size is cached otherwise
 
+# screen size and device count of the last full redraw
+_last_layout: tuple[int, int, int] = (0, 0, 0)
+_dirty_ids: set[int] = set()  # devices with a new heartbeat since last draw
 
-@dataclass
+
+@dataclass(slots=True)
 class Device:
     node_id: int
     is_icu: bool = False
     last_heartbeat: canp.HeartbeatMessage | None = None
 
+    # formatted row and the heartbeat it was built from
+    _row: str = field(default="", init=False, repr=False, compare=False)
+    _row_hb: canp.HeartbeatMessage | None = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
     def get_display_data(self) -> str:
-        """Get formatted string for display, handling unknown devices and message changes"""
+        """Get formatted row, rebuilt only when a new heartbeat was received"""
+        if self._row and self._row_hb is self.last_heartbeat:
+            return self._row
+
+        self._row = self._format_row()
+        self._row_hb = self.last_heartbeat
+        return self._row
+
+    def _format_row(self) -> str:
+        """Format string for display, handling unknown devices"""
         if not self.is_icu or self.last_heartbeat is None:
-            return f"| {self.node_id:<6} | {'--':<7} | {'--':<7} |  {'--':<8} | {'--':<6}| {'--':<7} |"
+            return f"| {self.node_id:<6} | {'--':<7} | {'--':<8} | {'--':<8} | {'--':<5} | {'--':<7} |"
 
+        # heartbeats are decoded with the protocol's own layout, fields always exist
         hb = self.last_heartbeat
-        # Convert io_state to binary string, pad to 8 bits
-        io_state_bin = format(getattr(hb, "io_state", 0), "08b")
-        io_dir_bin = format(getattr(hb, "io_dir", 0), "08b")
 
-        # Use getattr with default to handle possible changes in heartbeat message
-        dev_type = getattr(hb, "device_type", "--")
-        errors = getattr(hb, "errors", "--")
-        counter = getattr(hb, "counter", "--")
+        return f"| {self.node_id:<6} | {hb.device_type:<7} | {_IO_BIN[hb.io_dir]} | {_IO_BIN[hb.io_state]} | 0x{hb.errors:<3x} | {hb.counter:<7} |"
 
-        return f"| {self.node_id:<6} | {dev_type:<7} | {io_dir_bin:<7} | {io_state_bin:<8} | 0x{errors:<4x}| {counter:<7} |"
+
+def handle_heartbeat(node_id: int, data: bytearray) -> None:
+    """Update device table from a heartbeat frame"""
+    try:
+        hb_msg = canp.HeartbeatMessage._make(_HB_STRUCT.unpack(data))
+        if node_id not in devices:
+            add_device(Device(node_id, is_icu=True, last_heartbeat=hb_msg))
+        else:
+            devices[node_id].last_heartbeat = hb_msg
+            _dirty_ids.add(node_id)
+    except struct.error:  # wrong number of bytes
+        if node_id not in devices:
+            add_device(Device(node_id, is_icu=False))
+
+
+# opcode: handler(node_id, data), other opcodes are ignored
+_HANDLERS: dict[int, Callable[[int, bytearray], None]] = {
+    HB_OPCODE: handle_heartbeat,
+}
 
 
 def handle_msg(msg: can.Message) -> None:
-    # check if the message is a heartbeat
-    node_id, opcode = canp.split_message_id(msg.arbitration_id)
+    handler = _HANDLERS.get(msg.arbitration_id & canp.OPCODE_MASK)
+    if handler is not None:
+        handler(msg.arbitration_id >> canp.OPCODE_BITS, msg.data)
 
-    if opcode == HB_OPCODE:
-        try:
-            hb_msg = canp.decode_message(msg.arbitration_id, msg.data)
-            if not isinstance(hb_msg, canp.HeartbeatMessage):
-                raise ValueError("Invalid heartbeat message")
-            if node_id not in devices:
-                devices[node_id] = Device(node_id, is_icu=True, last_heartbeat=hb_msg)
-            else:
-                devices[node_id].last_heartbeat = hb_msg
-        except struct.error:  # wrong number of bytes
-            if node_id not in devices:
-                devices[node_id] = Device(node_id, is_icu=False)
-
-
-def signal_handler(signum, frame) -> None:
+
+def add_device(device: Device) -> None:
+    """Register a new device, keeping display order sorted"""
+    devices[device.node_id] = device
+    bisect.insort(_sorted_ids, device.node_id)
+
+
+def signal_handler(signum: int, frame: FrameType | None) -> None:
     """Handle keyboard interrupt"""
     global should_exit  # pylint: disable=global-statement
     should_exit = True
 
 
-def draw_table(pad: curses.window, screen: curses.window) -> None:
-    """Draw the table using a pad"""
-    height, width = screen.getmaxyx()
-    pad.erase()
+def resize_handler(signum: int, frame: FrameType | None) -> None:
+    """Handle terminal resize, applied before the next draw"""
+    global screen_resized  # pylint: disable=global-statement
+    screen_resized = True
+
+
+def resize_screen(pad: curses.window) -> tuple[int, int]:
+    """Resize curses to the terminal size, returns (height, width)"""
+    global screen_resized  # pylint: disable=global-statement
+    screen_resized = False
 
-    # Draw header
-    header = f"| {'NodeID':<6} | {'DevType':<7} | {'IO Dir':<8} | {'IO State':<8} | {'Error':<4} | {'Counter':<7} |"
-    pad.addstr(0, 0, header)
-    pad.addstr(1, 0, "-" * len(header))
+    width, height = os.get_terminal_size()
+    curses.resizeterm(height, width)
+    pad.resize(PAD_ROWS, width)
+    return height, width
 
-    # Draw data
-    for idx, (_, device) in enumerate(sorted(devices.items()), start=2):
-        row = device.get_display_data()
-        pad.addstr(idx, 0, row)
+
+def draw_table(pad: curses.window, height: int, width: int) -> bool:
+    """Draw the table using a pad. The full table is only redrawn when the
+    screen size or device list changed, otherwise just the updated rows.
+    Returns True if the screen needs an update (`curses.doupdate`)."""
+    global _last_layout  # pylint: disable=global-statement
+
+    layout = (height, width, len(_sorted_ids))
+    if layout != _last_layout:
+        _last_layout = layout
+
+        # Draw header and data in a single call
+        lines: list[str] = [HEADER, SEPARATOR]
+        lines.extend(devices[node_id].get_display_data() for node_id in _sorted_ids)
+
+        pad.erase()
+        pad.addstr(0, 0, "\n".join(lines))
+
+    elif _dirty_ids:
+        for node_id in _dirty_ids:
+            row = bisect.bisect_left(_sorted_ids, node_id) + 2  # below header
+            pad.addstr(row, 0, devices[node_id].get_display_data())
+            pad.clrtoeol()
+
+    else:
+        return False
+
+    _dirty_ids.clear()
 
     # Calculate visible area
     visible_rows = height - 1
     visible_cols = width - 1
 
-    # Copy the pad contents to the screen
-    pad.refresh(0, 0, 0, 0, visible_rows, visible_cols)
+    # Copy the pad contents to the virtual screen
+    pad.noutrefresh(0, 0, 0, 0, visible_rows, visible_cols)
+    return True
+
+
+async def monitor_loop(pad: curses.window, screen: curses.window) -> None:
+    """Buffer messages from the notifier thread, handle them in batches and
+    redraw at a fixed rate"""
+    rx_buffer: deque[can.Message] = deque(maxlen=RX_BUFFER_SIZE)
+
+    with get_can_bus() as bus:
+        # deque.append is thread safe, no event loop wakeup per frame
+        notifier = can.Notifier(bus, [rx_buffer.append])
+        height, width = screen.getmaxyx()
+        try:
+            while not should_exit:
+                while rx_buffer:
+                    handle_msg(rx_buffer.popleft())
+
+                if screen_resized:
+                    height, width = resize_screen(pad)
+
+                if draw_table(pad, height, width):  # no-op if nothing changed
+                    curses.doupdate()
+                await asyncio.sleep(RENDER_PERIOD)
+        finally:
+            notifier.stop()
 
 
 def main(stdscr: curses.window) -> None:
@@ -103,22 +204,14 @@ def main(stdscr: curses.window) -> None:
 
     # Create a pad larger than the screen
     _, width = stdscr.getmaxyx()
-    pad = curses.newpad(1000, width)  # Support up to 1000 rows
+    pad = curses.newpad(PAD_ROWS, width)
 
-    # Set up signal handler for Ctrl+C
+    # Set up signal handlers for Ctrl+C and terminal resize
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGWINCH, resize_handler)
 
     try:
-        with get_can_bus() as bus:
-            while not should_exit:
-                # Check for messages
-                msg = bus.recv(timeout=0.1)  # 100ms timeout
-                if msg is not None:
-                    handle_msg(msg)
-
-                # Update display
-                draw_table(pad, stdscr)
-
+        asyncio.run(monitor_loop(pad, stdscr))
     except Exception as e:
         curses.endwin()
         raise e
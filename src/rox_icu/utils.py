@@ -8,22 +8,13 @@ Copyright (c) 2024 ROX Automation - Jev Kuznetsov
 import asyncio
 import logging
 import os
-from typing import Any, Coroutine, Callable, Union, TypeVar
+from typing import Any, Coroutine, Callable
 
 import coloredlogs
 
 LOG_FORMAT = "%(asctime)s [%(name)s] %(filename)s:%(lineno)d - %(message)s"
 TIME_FORMAT = "%H:%M:%S.%f"
 
-# Type variable for the return type of the callable/coroutine
-T = TypeVar("T")
-
-# Define a type alias for our supported function types
-MainFunction = Union[
-    Callable[[], T],  # Regular synchronous function
-    Coroutine[Any, Any, T],  # Coroutine
-]
-
 
 def setup_logging() -> None:
     """Setup logging"""
@@ -33,17 +24,19 @@ def setup_logging() -> None:
 
 
 def get_root_exception(exc: BaseException) -> BaseException:
-    """Traverse the exception chain to find the root cause."""
-    if isinstance(exc, ExceptionGroup):
-        # If it's an ExceptionGroup, recursively check its exceptions
-        for e in exc.exceptions:
-            return get_root_exception(e)
-    while exc.__cause__ is not None:
-        exc = exc.__cause__
-    return exc
-
-
-def run_main(func: Callable) -> None:
+    """Traverse the exception chain to find the root cause.
+    Exception groups are followed through their first exception."""
+    while True:
+        if isinstance(exc, ExceptionGroup) and exc.exceptions:
+            exc = exc.exceptions[0]
+        elif exc.__cause__ is not None:
+            exc = exc.__cause__
+        else:
+            return exc
+
+
+def run_main(func: Callable[[], Any]) -> None:
+    """Run a synchronous entry point, for coroutines use `run_main_async`"""
     setup_logging()
 
     try:
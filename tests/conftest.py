@@ -1,9 +1,15 @@
 # type: ignore
 
+import asyncio
 import pytest
 from unittest.mock import MagicMock
 import sys
 
+try:  # optional, faster event loop
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 class CAN:
     def __init__(self, *args, **kwargs):
@@ -25,6 +31,13 @@ class Message:
         self.data = data
 
 
+def pytest_asyncio_loop_factories(config, item):
+    """run async tests on uvloop when it is installed"""
+    if uvloop is None:
+        return {"asyncio": asyncio.new_event_loop}
+    return {"uvloop": uvloop.new_event_loop}
+
+
 # A fixture that runs once per test session
 @pytest.fixture(scope="session", autouse=True)
 def mock_hardware_modules():
@@ -1,16 +1,18 @@
-# pylint: disable=protected-access
+# pylint: disable=protected-access, redefined-outer-name
 import asyncio
+import can
 import pytest
 
-from rox_icu.core import Pin
+import rox_icu.can_protocol as canp
+from rox_icu.core import ICU, Pin
 
 
-def get_pin() -> Pin:
+@pytest.fixture
+def pin() -> Pin:
     return Pin(5)
 
 
-def test_pin_initial_state():
-    pin = get_pin()
+def test_pin_initial_state(pin: Pin):
     assert not pin.state
     assert pin.number == 5
     assert pin.high_event is not None
@@ -19,8 +21,7 @@ def test_pin_initial_state():
 
 
 @pytest.mark.asyncio
-async def test_pin_set_state():
-    pin = get_pin()
+async def test_pin_set_state(pin: Pin):
     pin._update(True)
     assert not pin.is_input
     assert pin.state
@@ -29,8 +30,7 @@ async def test_pin_set_state():
 
 
 @pytest.mark.asyncio
-async def test_on_high_event():
-    pin = get_pin()
+async def test_on_high_event(pin: Pin):
     assert not pin.state
 
     # both events should be cleared
@@ -53,8 +53,7 @@ async def test_on_high_event():
 
 
 @pytest.mark.asyncio
-async def test_on_low_event():
-    pin = get_pin()
+async def test_on_low_event(pin: Pin):
 
     # both events should be cleared
     assert not pin.low_event.is_set()
@@ -79,9 +78,7 @@ async def test_on_low_event():
 
 
 @pytest.mark.asyncio
-async def test_on_change() -> None:
-
-    pin = get_pin()
+async def test_on_change(pin: Pin) -> None:
     assert not pin.state
 
     async def toggle_state_loop(pin: Pin) -> None:
@@ -89,34 +86,78 @@ async def test_on_change() -> None:
 
         for _ in range(10):
             pin._update(not pin.state)
-            await asyncio.sleep(0.001)
+            await asyncio.sleep(0)
 
     async def on_change_counter() -> int:
         """count on_change events with a timeout"""
         count = 0
         try:
             while True:
-                await asyncio.wait_for(pin.change_event.wait(), timeout=0.1)
+                async with asyncio.timeout(0.1):
+                    await pin.change_event.wait()
                 count += 1
-        except asyncio.TimeoutError:
+        except TimeoutError:
             pass
 
         return count
 
-    # Run both coroutines concurrently
-    counter_task = asyncio.create_task(on_change_counter())
-    toggle_task = asyncio.create_task(toggle_state_loop(pin))
-
-    # Wait for toggle_task to complete first
-    await toggle_task
+    # Count in the background while toggling, the counter finishes on its timeout
+    async with asyncio.TaskGroup() as tg:
+        counter_task = tg.create_task(on_change_counter())
+        await toggle_state_loop(pin)
 
-    # Then wait for counter_task (it will finish when timeout occurs)
-    count = await counter_task
+    count = counter_task.result()
 
     # Since we toggled 10 times, we should have 10 changes
     assert count == 10
 
 
+@pytest.mark.asyncio
+async def test_ignore_set_command() -> None:
+    """set commands (e.g. own echoes) are not state reports"""
+    bus = can.Bus(interface="virtual")
+    icu = ICU(1, can_bus=bus)
+    handler_task = asyncio.create_task(icu._message_handler())
+
+    try:
+        for op, io_state in [(canp.Operation.SET, 0x01), (0, 0x02)]:
+            await icu._msg_queue.put(
+                canp.encode_message(canp.IoStateMessage(op, io_state), node_id=1)
+            )
+
+        # messages are handled in order, so the set command has been seen by now
+        async with asyncio.timeout(1.0):
+            await icu.pins[1].high_event.wait()
+        assert icu.io_state == 0x02
+        assert not icu.pins[0].change_event.is_set()
+
+    finally:
+        handler_task.cancel()
+        await asyncio.gather(handler_task, return_exceptions=True)
+        bus.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_update_io_state() -> None:
+    bus = can.Bus(interface="virtual")
+    icu = ICU(1, can_bus=bus)
+
+    try:
+        icu._uptate_io_state(0b1000_0101)
+        assert [pin.state for pin in icu.pins] == [1, 0, 1, 0, 0, 0, 0, 1]
+        assert icu.pins[7].high_event.is_set()
+        assert not icu.pins[1].change_event.is_set()
+
+        icu.pins[7].change_event.clear()
+        icu._uptate_io_state(0b0000_0101)
+        assert not icu.pins[7].state
+        assert icu.pins[7].low_event.is_set()
+        assert not icu.pins[0].low_event.is_set()
+
+    finally:
+        bus.shutdown()
+
+
 # @pytest.mark.asyncio
 # async def test_heartbeat() -> None:
 
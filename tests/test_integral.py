@@ -22,8 +22,9 @@ async def test_loopback():
 
     try:
 
-        await asyncio.wait_for(icu.start(), timeout=1.0)
-        await asyncio.sleep(0.2)  # increment counter
+        async with asyncio.timeout(1.0):
+            await icu.start()
+        await icu.wait_for_heartbeat()  # next heartbeat, counter is incremented
 
         hb = icu.last_heartbeat
         assert hb is not None
@@ -33,11 +34,12 @@ async def test_loopback():
         pin = icu.pins[0]
         pin.state = True  # set command over can bus
 
-        await asyncio.wait_for(pin.high_event.wait(), timeout=1.0)
+        async with asyncio.timeout(1.0):
+            await pin.high_event.wait()
         assert mock.io_state == 0x01
         assert not pin.high_event.is_set()
 
-    except asyncio.TimeoutError:
+    except TimeoutError:
         assert False, "Timeout waiting for high event"
 
     finally:
@@ -1,35 +1,234 @@
+# pylint: disable=protected-access, redefined-outer-name
 import asyncio
 import json
 import os
+import threading
+import time
 import aiomqtt
+import can
+import msgspec
 import pytest
+import pytest_asyncio
 
-from rox_icu.mock import ICUMock
+import rox_icu.can_protocol as canp
+from rox_icu.can_utils import get_can_bus
+from rox_icu.mock import (
+    HB_COUNTER_OFFSET,
+    ICUMock,
+    SetPinCommand,
+    SharedNotifier,
+    field_offset,
+    sleep_until_next,
+)
 
 NODE_ID = 10
 
 
+@pytest_asyncio.fixture(scope="module", loop_scope="module")
+async def running_mock():
+    """one running mock shared by the tests in this module"""
+    mock = ICUMock(NODE_ID)
+    task = asyncio.create_task(mock.main())
+
+    yield mock
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+@pytest.fixture
+def mock(running_mock):
+    """shared mock, reset to its initial state"""
+    running_mock.disable_toggles()
+    running_mock.io_state = 0
+    return running_mock
+
+
+@pytest_asyncio.fixture(scope="module", loop_scope="module")
+async def mqtt_client():
+    """one broker connection for the module, subscribed to mock state updates"""
+    async with aiomqtt.Client("localhost") as client:
+        await client.subscribe(f"{ICUMock.MQTT_BASE_TOPIC}/+/state")
+        yield client
+
+
+async def next_state(client: aiomqtt.Client) -> int:
+    """wait for the next published mock state"""
+    async with asyncio.timeout(1.0):
+        message = await anext(client.messages)
+    return int(message.payload)  # type: ignore
+
+
 @pytest.mark.skipif(os.getenv("CI") is not None, reason="Skipped in CI environment")
-@pytest.mark.asyncio
-async def test_mqtt_commands():
+@pytest.mark.asyncio(loop_scope="module")
+async def test_mqtt_commands(mqtt_client):
 
     mock = ICUMock(NODE_ID, simulate_inputs=False, mqtt_broker="localhost")
 
-    asyncio.create_task(mock.main())
+    task = asyncio.create_task(mock.main())
 
     assert mock.io_state == 0
 
-    async with aiomqtt.Client("localhost") as mqtt:
-        await asyncio.sleep(0.1)
+    try:
+        await asyncio.sleep(0.1)  # mock subscribes to its command topic
 
         cmd_topic = f"{ICUMock.MQTT_BASE_TOPIC}/{NODE_ID}/cmd"
         msg = {"cmd": "set_pin", "args": {"pin": 0, "state": 1}}
-        await mqtt.publish(cmd_topic, json.dumps(msg))
-        await asyncio.sleep(0.1)
+        await mqtt_client.publish(cmd_topic, json.dumps(msg))
+        assert await next_state(mqtt_client) == 0x01
         assert mock.io_state == 0x01
 
         # set pin 2
         msg = {"cmd": "set_pin", "args": {"pin": 1, "state": 1}}
-        await mqtt.publish(cmd_topic, json.dumps(msg))
-        await asyncio.sleep(0.1)
+        await mqtt_client.publish(cmd_topic, json.dumps(msg))
+        assert await next_state(mqtt_client) == 0x03
         assert mock.io_state == 0x03
+
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_decode_command():
+    decoder = msgspec.json.Decoder(SetPinCommand)
+    command = decoder.decode(b'{"cmd": "set_pin", "args": {"pin": 1, "state": 0}}')
+    assert command.args.pin == 1
+    assert not command.args.state
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        b'{"cmd": "unknown", "args": {"pin": 1, "state": 0}}',
+        b'{"args": {"pin": 1, "state": 0}}',  # missing cmd
+        b'{"cmd": "set_pin", "args": {"pin": 1, "state": "on"}}',
+    ],
+)
+def test_decode_invalid_command(payload: bytes):
+    with pytest.raises(msgspec.ValidationError):
+        msgspec.json.Decoder(SetPinCommand).decode(payload)
+
+
+@pytest.mark.asyncio
+async def test_sleep_until_next():
+    period_ns = 10_000_000
+
+    start_ns = time.monotonic_ns()
+    deadline_ns = await sleep_until_next(start_ns, period_ns)
+    assert deadline_ns == start_ns + period_ns
+    assert time.monotonic_ns() >= deadline_ns - 1_000_000  # timer resolution
+
+    # far behind schedule, deadline is reset instead of bursting
+    deadline_ns = await sleep_until_next(start_ns - 1_000_000_000, period_ns)
+    assert deadline_ns >= start_ns
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_set_pin(mock):
+    mock.set_pin(0, True)
+    assert mock.io_state == 0x01
+    mock.set_pin(3, 1)  # type: ignore
+    assert mock.io_state == 0x09
+    mock.set_pin(0, False)
+    assert mock.io_state == 0x08
+
+    # unchanged state is not sent again
+    mock.io_state_changed.clear()
+    mock.set_pin(0, False)
+    assert mock.io_state == 0x08
+    assert not mock.io_state_changed.is_set()
+
+    # any truthy int sets the pin
+    mock.set_pin(5, 2)  # type: ignore
+    assert mock.io_state == 0x28
+    mock.set_pin(1, -1)  # type: ignore
+    assert mock.io_state == 0x2A
+
+
+def test_field_offset():
+    msg = canp.HeartbeatMessage(1, 2, 3, 4, 5)
+    _, data = canp.encode_message(msg, 1)
+
+    for field in msg._fields:
+        assert data[field_offset(canp.HeartbeatMessage, field)] == getattr(msg, field)
+
+
+@pytest.mark.asyncio
+async def test_stalled_bus_no_burst():
+    """a frame that is still queued is not queued again while the bus stalls"""
+    bus = can.Bus(interface="virtual")
+    mock = ICUMock(20, can_bus=bus)
+
+    sent: list[bytes] = []
+    unblock = threading.Event()
+
+    def stalled_send(msg: can.Message, timeout: float | None = None) -> None:
+        unblock.wait()
+        sent.append(bytes(msg.data))
+
+    bus.send = stalled_send  # type: ignore
+
+    try:
+        for counter in range(10):
+            mock._send_heartbeat(counter)
+        unblock.set()
+        await mock.aclose()
+
+        # at most the frame held by the stalled send plus one with the latest data
+        assert len(sent) <= 2
+        assert sent[-1][HB_COUNTER_OFFSET] == 9
+
+    finally:
+        unblock.set()
+        bus.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_shared_bus():
+    """two mocks on one bus share a notifier, frames are dispatched by node id"""
+
+    bus = get_can_bus()
+    mocks = [ICUMock(node_id, can_bus=bus) for node_id in (11, 12)]
+    tasks = [asyncio.create_task(mock.main()) for mock in mocks]
+
+    try:
+        await asyncio.sleep(0.1)
+        notifier = SharedNotifier.get_or_create(bus)
+        assert len(notifier._subscribers) == 2  # pylint: disable=protected-access
+
+        with get_can_bus() as tx_bus:
+            arb_id, data = canp.encode_message(canp.IoStateMessage(1, 0x05), 12)
+            tx_bus.send(
+                can.Message(arbitration_id=arb_id, data=data, is_extended_id=False)
+            )
+
+            async with asyncio.timeout(1.0):
+                while mocks[1].io_state != 0x05:
+                    await mocks[1].io_state_changed.wait()
+
+        assert mocks[0].io_state == 0
+
+        # the bus is handed back unfiltered once both mocks have stopped
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert bus.filters is None
+
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        bus.shutdown()
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_toggles(mock):
+    mock.enable_toggles()
+    async with asyncio.timeout(1.0):
+        while not mock.io_state & 0x80:
+            await mock.io_state_changed.wait()
+
+    mock.disable_toggles()
+    state = mock.io_state
+    await asyncio.sleep(0.6)
+    assert mock.io_state == state
@@ -1,3 +1,4 @@
+import random
 import struct
 
 import pytest
@@ -22,11 +23,19 @@ def test_node_id() -> None:
         assert canp.get_node_id(canp.generate_message_id(node_id, 0)) == node_id
 
 
+def test_id_masks() -> None:
+    message_id = canp.generate_message_id(63, 31)
+    assert message_id & canp.NODE_ID_MASK == message_id & ~canp.OPCODE_MASK
+    assert message_id & canp.OPCODE_MASK == 31
+    assert message_id >> canp.OPCODE_BITS == 63
+
+
 def test_roundtip() -> None:
-    for endpoint in range(32):
-        for node_id in range(64):
-            message_id = canp.generate_message_id(node_id, endpoint)
-            assert canp.split_message_id(message_id) == (node_id, endpoint)
+    expected = [(node_id, opcode) for opcode in range(32) for node_id in range(64)]
+    message_ids = [canp.generate_message_id(*pair) for pair in expected]
+
+    assert [canp.split_message_id(message_id) for message_id in message_ids] == expected
+    assert len(set(message_ids)) == len(expected)  # all ids are unique
 
 
 def test_invalid_message() -> None:
@@ -37,33 +46,35 @@ def test_invalid_message() -> None:
         canp.get_opcode_and_bytedef(InvalidMessage)  # type: ignore
 
 
-def test_halt() -> None:
-    test_bytes = b"\x01"
-
-    msg = canp.HaltMessage(1)
-    assert msg.io_state == 1
-
-    opcode, byte_def = canp.get_opcode_and_bytedef(canp.HaltMessage)
-    assert opcode == 0
-    assert byte_def == "<B"
+@pytest.mark.parametrize(
+    "msg, opcode, byte_def, test_bytes",
+    [
+        (canp.HaltMessage(1), 0, "<B", b"\x01"),
+        (
+            canp.HeartbeatMessage(1, 2, 0xBE, 0xEF, 0xFF),
+            1,
+            "<BBBBB",
+            b"\x01\x02\xbe\xef\xff",
+        ),
+        (canp.IoStateMessage(canp.Operation.SET, 0xA5), 2, "<BB", b"\x01\xa5"),
+    ],
+)
+def test_fixed_size_message(msg, opcode: int, byte_def: str, test_bytes: bytes) -> None:
+    assert canp.get_opcode_and_bytedef(type(msg)) == (opcode, byte_def)
 
     data_bytes = struct.pack(byte_def, *msg)
-
-    assert data_bytes == test_bytes
-
-    # use function
-    arb_id, data_bytes = canp.encode_message(msg, 1)
     assert data_bytes == test_bytes
 
     # convert back
-    msg2 = canp.HaltMessage(*struct.unpack(byte_def, test_bytes))
-
-    assert msg == msg2
+    assert type(msg)(*struct.unpack(byte_def, test_bytes)) == msg
 
+    # use functions
+    msg_id, data_bytes = canp.encode_message(msg, 1)
+    assert data_bytes == test_bytes
+    assert canp.decode_message(msg_id, data_bytes) == msg
 
-def test_heartbeat() -> None:
-    test_bytes = b"\x01\x02\xbe\xef\xff"
 
+def test_heartbeat_fields() -> None:
     msg = canp.HeartbeatMessage(1, 2, 0xBE, 0xEF, 0xFF)
     assert msg.device_type == 1
     assert msg.io_dir == 2
@@ -71,35 +82,24 @@ def test_heartbeat() -> None:
     assert msg.errors == 0xEF
     assert msg.counter == 0xFF
 
-    opcode, byte_def = canp.get_opcode_and_bytedef(canp.HeartbeatMessage)
-    assert opcode == 1
-    assert byte_def == "<BBBBB"
-
-    data_bytes = struct.pack(byte_def, *msg)
-    assert data_bytes == test_bytes
-
-    # # convert back
-    msg2 = canp.HeartbeatMessage(*struct.unpack(byte_def, test_bytes))
-
-    assert msg == msg2
-
-    # use function
-    _, data_bytes = canp.encode_message(msg, 1)
-    assert data_bytes == test_bytes
-
 
-def test_pack_unpack() -> None:
-    test_bytes = b"\x01\x02\xbe\xef\xff"
+def test_heartbeat_bulk_roundtrip() -> None:
+    rng = random.Random(0)
+    messages = [
+        canp.HeartbeatMessage(*(rng.randrange(256) for _ in range(5)))
+        for _ in range(10_000)
+    ]
+    frames = [canp.encode_message(msg, 1) for msg in messages]
+    msg_id, size = frames[0][0], len(frames[0][1])
 
-    msg = canp.HeartbeatMessage(1, 2, 0xBE, 0xEF, 0xFF)
+    # encode all into one buffer, decode each frame through the opcode table
+    buffer = b"".join(data for _, data in frames)
+    decoded = [
+        canp.decode_message(msg_id, buffer[i : i + size])
+        for i in range(0, len(buffer), size)
+    ]
 
-    msg_id, data_bytes = canp.encode_message(msg, 1)
-
-    assert data_bytes == test_bytes
-
-    # convert back
-    msg2 = canp.decode_message(msg_id, data_bytes)
-    assert msg == msg2
+    assert decoded == messages
 
 
 def test_get_param() -> None:
@@ -117,24 +117,11 @@ def test_get_param() -> None:
     assert data_bytes == b"\xFF\x01\x42\xFF"
 
 
-def test_param() -> None:
-
-    param_id, dtype = canp.device_parameters["test_param"]
-    msg = canp.ParameterMessage(param_id, 0, dtype, 1234)
-
-    assert msg.value == 1234
-
-    arb_id, data_bytes = canp.encode_message(msg, 1)
-
-    msg2 = canp.decode_message(arb_id, data_bytes)
-
-    assert msg == msg2
-
-
-def test_set_param() -> None:
+@pytest.mark.parametrize("op", [canp.Operation.GET, canp.Operation.SET])
+def test_param(op: int) -> None:
 
     param_id, dtype = canp.device_parameters["test_param"]
-    msg = canp.ParameterMessage(param_id, 1, dtype, 1234)
+    msg = canp.ParameterMessage(param_id, op, dtype, 1234)
 
     assert msg.value == 1234
 
@@ -0,0 +1,24 @@
+from rox_icu.utils import get_root_exception
+
+
+def test_get_root_exception():
+    root = ValueError("root")
+    assert get_root_exception(root) is root
+
+    try:
+        try:
+            raise root
+        except ValueError as e:
+            raise RuntimeError("wrapper") from e
+    except RuntimeError as e:
+        wrapped = e
+
+    assert get_root_exception(wrapped) is root
+
+    # groups are followed through the first exception, also inside a cause chain
+    group = ExceptionGroup("tasks", [wrapped, KeyError("other")])
+    assert get_root_exception(group) is root
+
+    outer = RuntimeError("outer")
+    outer.__cause__ = group
+    assert get_root_exception(outer) is root